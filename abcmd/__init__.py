@@ -2,24 +2,50 @@
 
 __version__ = "0.4.0"
 __author__ = "Konstantinos Tsakiltzidis <ktsakiltzidis@modulus.gr>"
-__all__ = ("Command",)
+__all__ = ("Command", "AsyncCommand")
 
 
 import abc
+import asyncio
+import os
 import re
+import selectors
 import shlex
 import subprocess as sp
 import sys
 from functools import lru_cache
 from string import Formatter
+from _string import formatter_field_name_split
 import logging
 
 if sys.version_info.minor < 5:
     import collections as cabc
-    from .typingstub import Any, Union, Sequence, Mapping, Callable
+    from .typingstub import (
+        Any,
+        Union,
+        Sequence,
+        Mapping,
+        Callable,
+        Dict,
+        Iterable,
+        List,
+        Optional,
+        Tuple,
+    )
 else:
     import collections.abc as cabc
-    from typing import Any, Union, Sequence, Mapping, Callable
+    from typing import (
+        Any,
+        Union,
+        Sequence,
+        Mapping,
+        Callable,
+        Dict,
+        Iterable,
+        List,
+        Optional,
+        Tuple,
+    )
 
 if sys.version_info.minor < 3:
 
@@ -29,6 +55,117 @@ if sys.version_info.minor < 3:
     sp.SubprocessError = SubprocessError
 
 
+_WHITESPACE = re.compile(r"\s+")
+_REGEX_SPECIAL_CHARS = frozenset(".^$*+?{}[]\\|()")
+
+
+_CONVERSIONS = {"s": "str", "r": "repr", "a": "ascii"}
+
+
+@lru_cache(maxsize=256)
+def _compile_template(template: str) -> Callable[[Mapping[str, Any]], str]:
+    """Generate a function rendering a template from a configuration.
+
+    The template is parsed once and turned to a single expression over its
+    literals and fields, templates are class level constants so the
+    generated functions are shared by all commands.
+    """
+    # helpers are bound as defaults so the body reads them as fast locals
+    source = (
+        "def render(config, _format_value=_format_value, str=str, format=format):\n"
+        "    return {}\n"
+    ).format(_template_expression(template))
+    namespace = {"_format_value": _format_value}
+    exec(compile(source, "<template {!r}>".format(template), "exec"), namespace)
+    return namespace["render"]
+
+
+def _template_expression(template: str, recursion_depth: int = 1) -> str:
+    """The python expression rendering ``template`` from ``config``.
+
+    Nested fields in format specs are rendered by nested expressions, with
+    the same recursion limit as ``str.format``.
+    """
+    if recursion_depth < 0:
+        raise ValueError("Max string recursion exceeded")
+
+    parts = []
+    for literal, flag, key, accessors, spec, conversion in _parse_template(template):
+        if literal:
+            parts.append(repr(literal))
+        if key is None:
+            continue
+        if key:
+            part = "_format_value({!r}, config[{!r}])".format(flag, key)
+        else:
+            # positional fields have no configuration entry
+            part = "''"
+        # attributes and indexes apply to the formatted value
+        for is_attr, name in accessors:
+            if is_attr:
+                part = "getattr({}, {!r})".format(part, name)
+            else:
+                part = "{}[{!r}]".format(part, name)
+        if conversion:
+            if conversion not in _CONVERSIONS:
+                raise ValueError("Unknown conversion specifier {}".format(conversion))
+            part = "{}({})".format(_CONVERSIONS[conversion], part)
+        if "{" in spec:
+            nested = _template_expression(spec, recursion_depth - 1)
+            part = "format({}, {})".format(part, nested)
+        elif spec:
+            part = "format({}, {!r})".format(part, spec)
+        elif key or accessors or conversion:
+            part = "str({})".format(part)
+        else:
+            continue
+        parts.append(part)
+
+    if len(parts) <= 4:
+        # concatenating a few pieces is cheaper than building a list to join
+        return "({})".format(" + ".join(parts) or "''")
+    return "''.join([{}])".format(", ".join(parts))
+
+
+@lru_cache(maxsize=1024)
+def _bool_flag(key: str) -> str:
+    """The long option for a boolean entry, ``READ_SPECIAL`` to ``--read-special``."""
+    return sys.intern("--" + key.lower().replace("_", "-"))
+
+
+def _parse_template(template: str) -> Tuple[Tuple[Any, ...], ...]:
+    """Tokenize a template.
+
+    Fields are returned as ``(literal, flag, key, accessors, spec, conversion)``
+    tuples where ``key`` is ``None`` for trailing literals and empty for
+    positional fields, which have no configuration entry, and ``accessors``
+    are the ``(is_attribute, name)`` pairs of ``.attribute`` and ``[index]``
+    lookups following the key.
+    """
+    parsed = []
+    for literal, field, spec, conversion in Formatter().parse(template):
+        accessors = ()  # type: Tuple[Tuple[bool, Any], ...]
+        if field is None:
+            flag, key = "", None
+        else:
+            first, rest = formatter_field_name_split(field)
+            accessors = tuple(rest)
+            if not first or isinstance(first, int):
+                flag, key = "", ""
+            else:
+                flag, key = _split_field(first)
+        parsed.append((literal, flag, key, accessors, spec or "", conversion))
+    return tuple(parsed)
+
+
+def _split_field(field: str) -> Tuple[str, str]:
+    """Split a ``-o OPTION`` field to its flag and configuration key."""
+    if not field.startswith("-"):
+        return "", field
+    flag, key, *_ = field.split()
+    return sys.intern(flag), key
+
+
 class CommandFormatter(Formatter):
     """Format strings based on command patterns and configuration entries.
 
@@ -55,115 +192,199 @@ class CommandFormatter(Formatter):
             the configuration that the formatting is based on
         """
         self._config = config
+        self._cache = {}  # type: Dict[str, str]
+        self._normalized = None  # type: Optional[Mapping[str, Any]]
+        self._version = 0
 
     @property
     def config(self):
-        self.__call__.cache_clear()
+        self._clear_cache()
         return self._config
 
-    @lru_cache()
+    def _clear_cache(self) -> None:
+        self._cache.clear()
+        self._normalized = None
+        self._version += 1
+
+    @staticmethod
+    def _normalize(config: Mapping[str, Any]) -> Mapping[str, Any]:
+        if not any(isinstance(val, bool) for val in config.values()):
+            return config
+        # don't polute the original config
+        return {
+            key: (_bool_flag(key) if val else "") if isinstance(val, bool) else val
+            for key, val in config.items()
+        }
+
     def __call__(self, template: str) -> str:
-        # don't polute self._config
-        config = {}
-        for key, val in self._config.items():
-            if isinstance(val, bool):
-                config[key] = "--" + key.lower().replace("_", "-") if val else ""
-            else:
-                config[key] = val
+        cached = self._cache.get(template)
+        if cached is not None:
+            return cached
+
+        if "{" not in template and "}" not in template:
+            # plain commands don't need the config
+            rendered = template
+        else:
+            if self._normalized is None:
+                self._normalized = self._normalize(self._config)
+            rendered = _compile_template(template)(self._normalized)
         # remove whitespace between args caused by empty optional parameters
-        return " ".join(self.format(template, **config).split())
+        formatted = _WHITESPACE.sub(" ", rendered).strip()
+        self._cache[template] = formatted
+        return formatted
 
     def get_value(
         self, key: Union[str, int], args: Sequence[Any], kwargs: Mapping[str, Any]
     ) -> Any:
+        # keeps ``format`` following the same field rules as the compiled templates
         if not isinstance(key, str):
             return ""
-        flag = ""
-        if key.startswith("-"):
-            flag, key, *_ = key.split()
-
-        val = super().get_value(key, args, kwargs)
-
-        if not val and val != 0:
-            val = ""
-        elif isinstance(val, (str, int)):
-            if flag:
-                val = "{} {}".format(flag, val)
-        elif isinstance(val, cabc.Iterable):
-            if flag:
-                val = ("{} {}".format(flag, v) for v in val)
-            val = " ".join(map(str, val))
-        else:
-            val = str(val)
-        return val
+        flag, key = _split_field(key)
+        return _format_value(flag, super().get_value(key, args, kwargs))
+
+
+def _format_value(flag: str, val: Any) -> Union[str, int]:
+    if not val and val != 0:
+        return ""
+    # exact type lookup is much cheaper than isinstance against the ABC
+    format_value = _VALUE_FORMATTERS.get(type(val))
+    if format_value is not None:
+        return format_value(flag, val)
+    elif isinstance(val, (str, int)):
+        return _format_scalar(flag, val)
+    elif isinstance(val, cabc.Iterable):
+        return _format_iterable(flag, val)
+    return str(val)
+
+
+def _format_scalar(flag: str, val: Union[str, int]) -> Union[str, int]:
+    return flag + " " + str(val) if flag else val
+
+
+def _format_iterable(flag: str, val: Iterable[Any]) -> str:
+    if flag:
+        values = list(map(str, val))
+        if not values:
+            return ""
+        # join with the flag as separator, no python level loop over values
+        return flag + " " + (" " + flag + " ").join(values)
+    return " ".join(map(str, val))
+
+
+_VALUE_FORMATTERS = {
+    str: _format_scalar,
+    int: _format_scalar,
+    list: _format_iterable,
+    tuple: _format_iterable,
+}
 
 
 class CommandDescriptor:
+    __slots__ = ("name", "template")
+
     def __init__(self, name, template):
         self.name = name
         self.template = template
-        self.runners = {}
 
     def __get__(self, command, cls):
         if not command:
             return self
-        if command in self.runners:
-            return self.runners[command]
 
-        runner = Process(self.name, command, self.template)
-        self.runners[command] = runner
+        runner = command._process(self.name, command, self.template)
+        # unless a subclass overrides the attribute, later lookups skip the
+        # descriptor and find the runner in the instance dict, the runner and
+        # the command only reference each other so they are collected together
+        if getattr(cls, self.name, None) is self:
+            command.__dict__[self.name] = runner
         return runner
 
 
 class Process:
+    __slots__ = (
+        "name",
+        "command",
+        "template",
+        "returncode",
+        "output",
+        "error",
+        "_formatted_command",
+        "_version",
+        "_argv",
+        "_argv_version",
+    )
+
     def __init__(self, name, command, template):
         self.name = name
         self.command = command
         self.template = template
+        self._formatted_command = None
+        self._version = None
+        self._argv = None
+        self._argv_version = None
 
     def __call__(self, *args, **kwargs):
-        self.returncode, self.output, self.error = self.command._runner(str(self))
+        command = self.command
+        runner = command._runner
+        if runner is _run_cmd:
+            # the default runner can skip tokenizing the same command again
+            result = runner(self.argv, max_output=command._max_output)
+        else:
+            result = runner(str(self))
+        self.returncode, self.output, self.error = result
         if self.returncode != 0:
             self.handle_error()
         return self
 
     def __str__(self):
-        self._formatted_command = self.command._formatter(self.template)
+        formatter = self.command._formatter
+        if self._version != formatter._version:
+            self._formatted_command = formatter(self.template)
+            self._version = formatter._version
         return self._formatted_command
 
-    def handle_error(self):
-        handlers = self.get_error_handlers()
+    @property
+    def argv(self) -> List[str]:
+        """The formatted command split to its arguments."""
+        formatted = str(self)
+        if self._argv_version != self._version:
+            self._argv = shlex.split(formatted)
+            self._argv_version = self._version
+        return self._argv
 
-        if handlers:
-            for handler in handlers:
-                if not handler(self.command, self.error):
-                    break
-            else:
-                return
-        elif hasattr(self.command, "handle_error"):
-            if self.command.handle_error(self._formatted_command, self.error):
+    def handle_error(self):
+        command = self.command
+        matched = False
+        # matching stops at the first handler that doesn't handle the error
+        for handler in self.get_error_handlers():
+            matched = True
+            if not handler(command, self.error):
+                break
+        else:
+            if matched:
                 return
+            if "handle_error" in command._hooks:
+                if command.handle_error(self._formatted_command, self.error):
+                    return
 
         msg = "{}: {}".format(self._formatted_command, self.error)
         logging.error("Unhandled error: " + msg)
         raise sp.SubprocessError(msg)
 
     def get_error_handlers(self):
-        return [
+        command = self.command
+        handlers = command._handlers_by_command.get(self.name, command._handlers)
+        return (
             handler
-            for handler in self.command._handlers
-            if self.is_matching_handler(handler)
-        ]
+            for command_name, error_pattern, rc, handler in handlers
+            if self.is_matching_handler(command_name, error_pattern, rc)
+        )
 
-    def is_matching_handler(self, handler):
-        command_name = handler._handler["command"]
+    def is_matching_handler(self, command_name, error_pattern, rc):
         if command_name and self.name != command_name:
             return False
-        error_pattern = handler._handler["error"]
-        if error_pattern and not re.search(error_pattern, self.error):
+        if error_pattern and not error_pattern.search(self.error):
             return False
-        rc_pattern = handler._handler["rc"]
-        if rc_pattern and rc_pattern != self.returncode:
+        if rc and rc != self.returncode:
             return False
         return True
 
@@ -171,12 +392,32 @@ class Process:
         return "{} runner at {}".format(self.name, id(self))
 
 
+class AsyncProcess(Process):
+    __slots__ = ()
+
+    async def __call__(self, *args, **kwargs):
+        command = self.command
+        runner = command._runner
+        if runner is _run_cmd_async:
+            result = await runner(self.argv, max_output=command._max_output)
+        else:
+            result = await runner(str(self))
+        self.returncode, self.output, self.error = result
+        if self.returncode != 0:
+            self.handle_error()
+        return self
+
+
+_HOOKS = ("dont_run", "before_run", "after_run", "handle_error")
+
+
 class MetaCommand(abc.ABCMeta):
     def __new__(cls, name, bases, namespace):
         if not bases:
             return super().__new__(cls, name, bases, namespace)
 
-        # gather from parent classes as well
+        # gather from parent classes as well, handlers are stored as
+        # (command, compiled error pattern, rc, method) tuples
         error_handlers = [
             handler for base in bases for handler in getattr(base, "_handlers", ())
         ]
@@ -185,13 +426,41 @@ class MetaCommand(abc.ABCMeta):
             if key.startswith("_"):
                 continue
             elif isinstance(val, str):
-                namespace[key] = CommandDescriptor(key, val)
+                # equal templates of different classes share cache entries
+                namespace[key] = CommandDescriptor(key, sys.intern(val))
             elif callable(val) and hasattr(val, "_handler"):
-                error_handlers.append(val)
-
-        namespace["_handlers"] = error_handlers
-
-        return super().__new__(cls, name, bases, namespace)
+                error_handlers.append(
+                    (
+                        val._handler["command"],
+                        val._handler_error,
+                        val._handler["rc"],
+                        val,
+                    )
+                )
+
+        namespace["_handlers"] = tuple(error_handlers)
+
+        # bucket the handlers that can match each command so dispatching an
+        # error doesn't scan the handlers of unrelated commands
+        names = {
+            key for key, val in namespace.items() if isinstance(val, CommandDescriptor)
+        }
+        for base in bases:
+            names.update(getattr(base, "_handlers_by_command", ()))
+        namespace["_handlers_by_command"] = {
+            name: tuple(
+                handler
+                for handler in error_handlers
+                if not handler[0] or handler[0] == name
+            )
+            for name in names
+        }
+
+        command = super().__new__(cls, name, bases, namespace)
+        # optional hooks are resolved once through the whole mro, so hooks of
+        # mixins listed after Command are found as well
+        command._hooks = frozenset(hook for hook in _HOOKS if hasattr(command, hook))
+        return command
 
 
 class Command(metaclass=MetaCommand):
@@ -232,30 +501,53 @@ class Command(metaclass=MetaCommand):
         will call that method on any matching errors, returing a
         falsy value will make the procedure stop
 
+      - Passing ``max_output`` on initiation keeps only the last
+        ``max_output`` bytes of the output and error of each command,
+        so verbose commands run in bounded memory, custom runners
+        are called with the formatted command only
+
 
     """
 
-    def __init__(self, config: Mapping, *, runner: Callable = None) -> None:
+    _process = Process
+
+    def __init__(
+        self,
+        config: Mapping,
+        *,
+        runner: Callable = None,
+        max_output: Optional[int] = None
+    ) -> None:
         self._config = config
         self._runner = runner if runner is not None else _run_cmd
+        self._max_output = max_output
         self._formatter = CommandFormatter(self._config)
 
     def __call__(self, *args: Any, **kwargs: Any) -> None:
         """Run the procedure."""
-        if hasattr(self, "dont_run") and self.dont_run():
+        hooks = self._hooks
+        if "dont_run" in hooks and self.dont_run():
             return
 
-        if hasattr(self, "before_run"):
+        if "before_run" in hooks:
             self.before_run()
 
         self.run(*args, **kwargs)
 
-        if hasattr(self, "after_run"):
+        if "after_run" in hooks:
             self.after_run()
 
+    def __getstate__(self) -> Dict[str, Any]:
+        # cached runners are bound to this instance, copies create their own
+        return {
+            key: val
+            for key, val in self.__dict__.items()
+            if not isinstance(val, Process)
+        }
+
     @property
     def config(self):
-        self._formatter.__call__.cache_clear()
+        self._formatter._clear_cache()
         return self._config
 
     @abc.abstractmethod
@@ -263,34 +555,188 @@ class Command(metaclass=MetaCommand):
         """Describe the procedure."""
 
 
-def _run_cmd(cmd: str) -> str:
-    command = shlex.split(cmd)
-    logging.debug("Running '%s':", cmd)
+class AsyncCommand(Command):
+    """Base class of command runners that run their commands concurrently.
+
+    Works like ``Command`` but calling a command attribute returns an awaitable
+    and ``run`` is a coroutine, independent commands can be awaited together
+    with ``asyncio.gather``, for example::
+
+        .. code:: python
+
+            class Sync(AsyncCommand):
+                pull = 'rsync {server}:{directory} .'
+                fetch = 'git -C {repo} fetch'
+
+                async def run(self):
+                    await asyncio.gather(self.pull(), self.fetch())
+
+    the hooks and error handlers are plain methods like in ``Command``.
+    """
+
+    _process = AsyncProcess
+
+    def __init__(
+        self,
+        config: Mapping,
+        *,
+        runner: Callable = None,
+        max_output: Optional[int] = None
+    ) -> None:
+        runner = runner if runner is not None else _run_cmd_async
+        super().__init__(config, runner=runner, max_output=max_output)
+
+    async def __call__(self, *args: Any, **kwargs: Any) -> None:
+        """Run the procedure."""
+        hooks = self._hooks
+        if "dont_run" in hooks and self.dont_run():
+            return
+
+        if "before_run" in hooks:
+            self.before_run()
+
+        await self.run(*args, **kwargs)
+
+        if "after_run" in hooks:
+            self.after_run()
+
+    @abc.abstractmethod
+    async def run(self, *args: Any, **kwargs: Any) -> None:
+        """Describe the procedure."""
+
+
+@lru_cache(maxsize=256)
+def _split_command(cmd: str) -> Tuple[str, ...]:
+    return tuple(shlex.split(cmd))
+
+
+def _log_running(cmd: Union[str, Sequence[str]]) -> None:
+    # joining argv is only worth it when the message is emitted
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        if not isinstance(cmd, str):
+            cmd = " ".join(map(shlex.quote, cmd))
+        logging.debug("Running '%s':", cmd)
+
+
+def _run_cmd(
+    cmd: Union[str, Sequence[str]], *, max_output: Optional[int] = None
+) -> Tuple[int, str, str]:
+    """Run a command and return its return code, output and error.
+
+    If ``max_output`` is given only the last ``max_output`` bytes of each
+    stream are kept so verbose commands run in bounded memory.
+    """
+    command = _split_command(cmd) if isinstance(cmd, str) else cmd
+    _log_running(cmd)
 
     proc = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
-    out, error = proc.communicate()  # block
-    try:
-        out = out.decode()
-        error = error.decode()
-    except UnicodeDecodeError:
+    if max_output is None:
+        out, error = proc.communicate()  # block
+    else:
+        out, error = _communicate_bounded(proc, max_output)
+    return (proc.returncode, _decode(out), _decode(error))
+
+
+def _communicate_bounded(proc: sp.Popen, max_output: int) -> Tuple[bytes, bytes]:
+    buffers = {proc.stdout: bytearray(), proc.stderr: bytearray()}
+    with selectors.DefaultSelector() as selector:
+        for pipe in buffers:
+            selector.register(pipe, selectors.EVENT_READ)
+        while selector.get_map():
+            for key, _ in selector.select():
+                chunk = os.read(key.fd, 65536)
+                if not chunk:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    continue
+                buf = buffers[key.fileobj]
+                buf += chunk
+                _keep_tail(buf, max_output)
+    proc.wait()
+    return bytes(buffers[proc.stdout]), bytes(buffers[proc.stderr])
+
+
+def _keep_tail(buf: bytearray, max_output: int) -> None:
+    if len(buf) <= max_output:
+        return
+    del buf[: len(buf) - max_output]
+    # don't start in the middle of a utf-8 sequence, decoding it would warn
+    start = 0
+    while start < min(3, len(buf)) and buf[start] & 0xC0 == 0x80:
+        start += 1
+    del buf[:start]
+
+
+async def _run_cmd_async(
+    cmd: Union[str, Sequence[str]], *, max_output: Optional[int] = None
+) -> Tuple[int, str, str]:
+    command = _split_command(cmd) if isinstance(cmd, str) else cmd
+    _log_running(cmd)
+
+    proc = await asyncio.create_subprocess_exec(
+        *command, stdout=sp.PIPE, stderr=sp.PIPE
+    )
+    if max_output is None:
+        out, error = await proc.communicate()
+    else:
+        out, error = await asyncio.gather(
+            _read_bounded(proc.stdout, max_output),
+            _read_bounded(proc.stderr, max_output),
+        )
+        await proc.wait()
+    return (proc.returncode, _decode(out), _decode(error))
+
+
+async def _read_bounded(stream: asyncio.StreamReader, max_output: int) -> bytes:
+    buf = bytearray()
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk:
+            return bytes(buf)
+        buf += chunk
+        _keep_tail(buf, max_output)
+
+
+def _decode(output: bytes) -> str:
+    text = output.decode(errors="replace")
+    # replacement characters that were not in the output are decoding errors
+    if "\ufffd" in text and text.count("\ufffd") > output.count(b"\xef\xbf\xbd"):
         msg = (
             "Unicode error while decoding command output, "
             "replacing offending characters."
         )
         logging.warning(msg)
-        out = out.decode(errors="replace")
-        error = error.decode(errors="replace")
-
-    return (proc.returncode, out, error)
+    return text
 
 
 def error_handler(command=None, error=None, rc=None):
     """Method decorator for handling specific errors.
     First argument is command to match too, the second argument
     is a regular expression to match the error."""
+    error_pattern = _compile_error_pattern(error) if error else None
 
     def wrapper(func):
         func._handler = {"command": command, "error": error, "rc": rc}
+        func._handler_error = error_pattern
         return func
 
     return wrapper
+
+
+class _Substring:
+    """Pattern-like matcher for error patterns without special characters."""
+
+    __slots__ = ("substring",)
+
+    def __init__(self, substring: str) -> None:
+        self.substring = substring
+
+    def search(self, text: str) -> bool:
+        return self.substring in text
+
+
+def _compile_error_pattern(pattern: str) -> Any:
+    if _REGEX_SPECIAL_CHARS.isdisjoint(pattern):
+        # a substring search is much cheaper than running the regex engine
+        return _Substring(pattern)
+    return re.compile(pattern)
@@ -9,4 +9,8 @@ Sequence = StubType()
 Mapping = StubType()
 Callable = StubType()
 Dict = StubType()
+Optional = StubType()
+Tuple = StubType()
+List = StubType()
+Iterable = StubType()
 IO = StubType()
@@ -1,5 +1,14 @@
+import os
+
 import setuptools
 
+
+def read(filename):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
 setuptools.setup(
     name="abcmd",
     version="0.5.0",
@@ -9,9 +18,10 @@ setuptools.setup(
     author_email="laerusk@gmail.com",
 
     description="Library for wrapping CLI commands with static configuration.",
-    long_description=open('README.rst').read(),
+    long_description=read('README.rst'),
+    long_description_content_type="text/x-rst",
 
-    packages=setuptools.find_packages(),
+    packages=["abcmd"],
 
     install_requires=[],
 
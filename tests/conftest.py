@@ -1,22 +1,24 @@
 import os
-import tempfile
 
 import pytest
 
 
 @pytest.fixture(
-    params=[("yaml", "---\ntest_entry: ok"), ("toml", 'test_entry = "ok"\n')]
+    scope="session",
+    params=[("yaml", "---\ntest_entry: ok"), ("toml", 'test_entry = "ok"\n')],
 )
-def config_file(request):
+def config_file_path(request, tmp_path_factory):
     extension, text = request.param
-    with tempfile.NamedTemporaryFile(suffix="." + extension) as config:
-        task = os.path.splitext(os.path.basename(config.name))[0]
+    directory = str(tmp_path_factory.mktemp(extension))
+    task = "config"
+    name = os.path.join(directory, task + "." + extension)
+    with open(name, "wb") as config:
         config.write(text.encode())
-        config.seek(0)
-        yield {
-            "task": task,
-            "path": os.path.dirname(config.name),
-            "name": config.name,
-            "loader": extension,
-            "file": config,
-        }
+    return {"task": task, "path": directory, "name": name, "loader": extension}
+
+
+@pytest.fixture()
+def config_file(config_file_path):
+    # the files are shared by the session, only the handle is per test
+    with open(config_file_path["name"], "rb") as config:
+        yield dict(config_file_path, file=config)
@@ -1,8 +1,21 @@
-from abcmd import Command, Process
+import copy
+import gc
+import logging
+import pickle
+import weakref
+
+from abcmd import Command, Process, _decode, _run_cmd
 
 import pytest
 
 
+class GreetCommand(Command):
+    greet = "echo hello {name}"
+
+    def run(self):
+        self.greet()
+
+
 @pytest.fixture()
 def run_cmd(mocker):
     return mocker.Mock(return_value=(0, "out", "err"))
@@ -16,7 +29,7 @@ def test_Command_init_arguments():
     with pytest.raises(TypeError) as err:
         MyCommand()
 
-    assert str(err).endswith(
+    assert str(err.value).endswith(
         "__init__() missing 1 required positional argument: 'config'"
     )
 
@@ -232,3 +245,154 @@ def test_Command_subclassing_with_override_attributes_as_methods_and_calling_sup
         "command OK",
         "subcommand attribute end",
     ]
+
+
+def test_Process_argv_follows_config_changes():
+    class MyCommand(Command):
+        attribute = "command {-o OPT} 'quoted arg'"
+
+        def run(self):
+            pass
+
+    command = MyCommand({"OPT": "first"})
+    assert command.attribute.argv == ["command", "-o", "first", "quoted arg"]
+
+    command.config["OPT"] = "second"
+    assert command.attribute.argv == ["command", "-o", "second", "quoted arg"]
+
+
+def test_Command_runners_do_not_keep_commands_alive():
+    class MyCommand(Command):
+        attribute = "command attribute"
+
+        def run(self):
+            pass
+
+    command = MyCommand({})
+    command.attribute
+    command_ref = weakref.ref(command)
+
+    del command
+    gc.collect()
+
+    assert command_ref() is None
+
+
+def test_Command_temporary_instance_runs_its_attributes():
+    def run(cmd):
+        return 0, cmd, ""
+
+    class MyCommand(Command):
+        greet = "echo hello {name}"
+
+        def run(self):
+            pass
+
+    def greet():
+        return MyCommand({"name": "world"}, runner=run).greet
+
+    proc = greet()
+    gc.collect()
+
+    assert str(proc) == "echo hello world"
+    assert proc().output == "echo hello world"
+    assert MyCommand({"name": "you"}, runner=run).greet().output == "echo hello you"
+
+
+def test_Command_copies_get_their_own_runners():
+    command = GreetCommand({"name": "world"})
+    command.greet
+
+    command_copy = copy.copy(command)
+
+    assert command_copy.greet.command is command_copy
+    assert command.greet.command is command
+
+
+def test_Command_pickles_after_running_attributes():
+    command = GreetCommand({"name": "world"})
+    assert str(command.greet) == "echo hello world"
+
+    restored = pickle.loads(pickle.dumps(command))
+
+    assert restored.config == {"name": "world"}
+    assert str(restored.greet) == "echo hello world"
+    assert restored.greet.command is restored
+
+
+@pytest.mark.parametrize(
+    "output, expected, warns",
+    [
+        (b"output", "output", False),
+        (b"output \xef\xbf\xbd", "output �", False),
+        (b"output \xff", "output �", True),
+    ],
+)
+def test_decode_replaces_invalid_output(caplog, output, expected, warns):
+    assert _decode(output) == expected
+    assert bool(caplog.records) is warns
+
+
+def test_run_cmd_keeps_the_end_of_bounded_output():
+    returncode, output, error = _run_cmd("seq 1 10000", max_output=10)
+
+    assert returncode == 0
+    assert output == "999\n10000\n"
+    assert error == ""
+
+
+def test_Command_finds_hooks_of_mixins_after_Command():
+    call_list = []
+
+    def run(cmd):
+        return 1, "out", "error"
+
+    class Hooks:
+        def before_run(self):
+            call_list.append("before_run")
+
+        def after_run(self):
+            call_list.append("after_run")
+
+        def handle_error(self, cmd, error):
+            call_list.append("handle_error")
+            return True
+
+    class MyCommand(Command, Hooks):
+        attribute = "command attribute"
+
+        def run(self):
+            self.attribute()
+
+    MyCommand({}, runner=run)()
+
+    assert call_list == ["before_run", "handle_error", "after_run"]
+
+
+def test_run_cmd_logs_the_command_line(caplog):
+    caplog.set_level(logging.DEBUG)
+
+    _run_cmd(["echo", "two words"])
+
+    assert "Running 'echo 'two words'':" in caplog.text
+
+
+def test_Command_bounds_output_with_max_output():
+    class MyCommand(Command):
+        seq = "seq 1 10000"
+
+        def run(self):
+            pass
+
+    proc = MyCommand({}, max_output=10).seq()
+
+    assert proc.output == "999\n10000\n"
+
+
+def test_run_cmd_bounded_output_starts_at_a_character(caplog):
+    returncode, output, error = _run_cmd(
+        ["printf", "\\303\\251\\303\\251\\303\\251"], max_output=5
+    )
+
+    assert output == "éé"
+    assert "Unicode error" not in caplog.text
@@ -0,0 +1,98 @@
+import asyncio
+import subprocess as sp
+
+import pytest
+
+from abcmd import AsyncCommand, Process
+
+
+def run_until_complete(coroutine):
+    loop = asyncio.new_event_loop()
+    # the child watcher of python < 3.8 needs the loop to be the current one
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def test_AsyncCommand_runs_commands_concurrently():
+    command_stream = []
+
+    async def run(cmd):
+        command_stream.append("start " + cmd)
+        await asyncio.sleep(0)
+        command_stream.append("end " + cmd)
+        return 0, "out", "err"
+
+    class MyCommand(AsyncCommand):
+        first = "first {OPTION}"
+        second = "second {OPTION}"
+
+        async def run(self):
+            await asyncio.gather(self.first(), self.second())
+
+    command = MyCommand({"OPTION": "ok"}, runner=run)
+    run_until_complete(command())
+
+    assert command_stream == [
+        "start first ok",
+        "start second ok",
+        "end first ok",
+        "end second ok",
+    ]
+
+
+def test_AsyncCommand_calling_attributes_returns_Process():
+    class MyCommand(AsyncCommand):
+        printf = "printf {OPTION}"
+
+        async def run(self):
+            pass
+
+    command = MyCommand({"OPTION": "hello"})
+    proc = run_until_complete(command.printf())
+
+    assert isinstance(proc, Process)
+    assert proc.returncode == 0
+    assert proc.output == "hello"
+    assert proc.error == ""
+
+
+def test_AsyncCommand_stops_if_handle_error_returns_False():
+    class MyCommand(AsyncCommand):
+        cat = "cat NON_EXISTING_FILE"
+
+        async def run(self):
+            await self.cat()
+
+        def handle_error(self, cmd, error):
+            return False
+
+    with pytest.raises(sp.SubprocessError):
+        run_until_complete(MyCommand({})())
+
+
+def test_AsyncCommand_temporary_instance_runs_its_attributes():
+    class MyCommand(AsyncCommand):
+        printf = "printf {OPTION}"
+
+        async def run(self):
+            pass
+
+    proc = run_until_complete(MyCommand({"OPTION": "hello"}).printf())
+
+    assert proc.output == "hello"
+
+
+def test_AsyncCommand_bounds_output_with_max_output():
+    class MyCommand(AsyncCommand):
+        seq = "seq 1 10000"
+
+        async def run(self):
+            pass
+
+    proc = run_until_complete(MyCommand({}, max_output=10).seq())
+
+    assert proc.output == "999\n10000\n"
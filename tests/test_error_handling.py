@@ -1,3 +1,4 @@
+import re
 import subprocess as sp
 
 import pytest
@@ -29,6 +30,36 @@ def test_error_handler_decorator_arguments(args, kwargs, expected):
     assert attrs == expected
 
 
+def test_error_handler_decorator_compiles_error_pattern():
+    @error_handler("cmd", "ERROR .*")
+    def handler(error):
+        ...
+
+    assert handler._handler_error.search("ERROR OUTPUT")
+
+
+@pytest.mark.parametrize(
+    "pattern, error, matches",
+    [
+        ("No such file", "cat: x: No such file or directory", True),
+        ("No such file", "cat: x: Permission denied", False),
+        ("No such .* directory", "cat: x: No such file or directory", True),
+        ("^No such", "cat: x: No such file or directory", False),
+    ],
+)
+def test_error_handler_patterns_match_as_regular_expressions(pattern, error, matches):
+    @error_handler(error=pattern)
+    def handler(error):
+        ...
+
+    assert bool(handler._handler_error.search(error)) is matches
+
+
+def test_error_handler_decorator_rejects_invalid_patterns():
+    with pytest.raises(re.error):
+        error_handler(error="ERROR (")
+
+
 def test_Command_calls_handle_error_on_subprocess_error():
     handle_list = []
 
@@ -145,7 +176,7 @@ def test_CommandRunner_error_handlers(rc, error, expected_handlers):
     runner = MyCommand({}, runner=run)
     runner()
 
-    assert sorted(handlers, key=str) == sorted(expected_handlers, key=str)
+    assert handlers == expected_handlers
 
 
 def test_subclass_inherits_error_handler_decorated_methods():
@@ -178,3 +209,63 @@ def test_subclass_inherits_error_handler_decorated_methods():
     assert (
         "handle_some_error" in command_flow and "another_error_handler" in command_flow
     )
+
+
+def test_error_handlers_stop_at_first_unhandled_error():
+    handlers = []
+
+    def run(cmd):
+        return 1, "out", "error"
+
+    class MyCommand(Command):
+        command = "command with args"
+
+        def run(self, *args, **kwargs):
+            self.command()
+
+        @error_handler("command")
+        def handler0(self, error):
+            handlers.append("handler0")
+            return False
+
+        @error_handler("command")
+        def handler1(self, error):
+            handlers.append("handler1")
+            return True
+
+    runner = MyCommand({}, runner=run)
+    with pytest.raises(sp.SubprocessError):
+        runner()
+
+    assert handlers == ["handler0"]
+
+
+def test_handlers_are_matched_for_commands_added_by_subclasses():
+    handlers = []
+
+    def run(cmd):
+        return 1, "out", "error"
+
+    class MyCommand(Command):
+        first = "first command"
+
+        def run(self, *args, **kwargs):
+            self.second()
+
+        @error_handler("second")
+        def handle_second(self, error):
+            handlers.append("handle_second")
+            return True
+
+        @error_handler("first")
+        def handle_first(self, error):
+            handlers.append("handle_first")
+            return True
+
+    class SubCommand(MyCommand):
+        second = "second command"
+
+    runner = SubCommand({}, runner=run)
+    runner()
+
+    assert handlers == ["handle_second"]
@@ -107,6 +107,15 @@ import pytest
         ("command {-o option option2}", {"option": "opt"}, "command -o opt"),
         # positional argument
         ("command {ARG}", {"ARG": 10}, "command 10"),
+        # conversion and format spec
+        ("command {ARG!r} {N:0>3}", {"ARG": "arg", "N": 7}, "command 'arg' 007"),
+        # field names are not evaluated
+        ("command {'__import__'}", {"'__import__'": "ok"}, "command ok"),
+        # indexes and attributes apply to the formatted value
+        ("command {ARG[0]} {N.real}", {"ARG": ["a", "b"], "N": 5}, "command a 5"),
+        # nested fields in format spec
+        ("command {ARG:>{WIDTH}}", {"ARG": "arg", "WIDTH": 5}, "command arg"),
+        ("command {N:0{WIDTH}}", {"N": 7, "WIDTH": 3}, "command 007"),
     ],
 )
 def test_CommandFormatter_format(config, template, expected):
@@ -128,3 +137,18 @@ def test_CommandFormatter_on_config_change():
 
     formatter.config["OPTION"] = "changed"
     assert formatter("command {OPTION}") == "command changed"
+
+
+def test_CommandFormatter_format_method_follows_field_rules():
+    formatter = CommandFormatter({})
+
+    assert formatter.format("command {-o OPTION}", OPTION=["a", "b"]) == (
+        "command -o a -o b"
+    )
+
+
+def test_CommandFormatter_limits_nested_fields_like_str_format():
+    formatter = CommandFormatter({"A": 1, "B": 2, "C": 3})
+
+    with pytest.raises(ValueError, match="Max string recursion exceeded"):
+        formatter("command {A:{B:{C}}}")